@@ -0,0 +1,257 @@
+# Study-wide summaries of penaltyshot sessions. Scans a data directory for
+# session files and keeps a table with one row per trial, saved alongside
+# the data so that only new sessions, or trials appended to sessions that
+# are still running, have to be read on the next update. Queries are then
+# just pandas group-bys on the table in memory.
+#
+#     study = Study('data')
+#     study.update()
+#     study.win_rate(['day', 'subject'])
+#     study.accel_profiles(by='winner')
+
+from __future__ import division, print_function
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+from encoding import decode_trial
+
+CACHE_NAME = 'study_summary.pkl'
+CACHE_VERSION = 1
+
+# bar acceleration is resampled to this many bins of normalized play time
+PROFILE_BINS = 20
+PROFILE_COLUMNS = ['bar_accel_p{:02d}'.format(b) for b in range(PROFILE_BINS)]
+
+def session_info(metadata, name):
+    # the per-session fields that are copied into every trial row
+    # sessions are identified by subject and start time, so that copies
+    # of the same session (e.g., converted files) are only counted once
+    config = metadata.get('config', {})
+    start = metadata.get('psychopy_start_time')
+    return {'file': name,
+            'session': ('{}@{}'.format(metadata.get('subject'), start)
+                        if start is not None else name),
+            'subject': metadata.get('subject'),
+            'p2': config.get('P2'),
+            'day': metadata.get('day'),
+            'start_time': metadata.get('start_time'),
+            'role': config.get('Role') or 'ball'}
+
+def _profile(values):
+    # mean of values in PROFILE_BINS equal bins of normalized time
+    if len(values) == 0:
+        return [np.nan] * PROFILE_BINS
+    bins = np.arange(len(values)) * PROFILE_BINS // len(values)
+    sums = np.bincount(bins, weights=values, minlength=PROFILE_BINS)
+    counts = np.bincount(bins, minlength=PROFILE_BINS)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).tolist()
+
+def summarize_trial(trial, info, index):
+    # Reduce one trial dict to a flat row for the summary table.
+    trial = decode_trial(trial)
+    ball = np.asarray(trial['ball_history'], dtype=float).reshape(-1, 4)
+    bar = np.asarray(trial['bar_history'], dtype=float).reshape(-1, 4)
+    ball_joy = np.asarray(trial['ball_joystick_history'], dtype=float).reshape(-1, 4)
+    bar_joy = np.asarray(trial['bar_joystick_history'], dtype=float).reshape(-1, 4)
+    accel = np.asarray(trial['bar_acceleration'], dtype=float)
+    times = trial.get('times', {})
+    network = trial.get('network') or {}
+
+    row = dict(info)
+    row.update({
+        'trial': index,
+        'winner': trial['winner'],
+        'win': (float(trial['winner'] == info['role'])
+                if trial['winner'] is not None else np.nan),
+        'frames': len(ball),
+        'play_duration': (times['play_end'] - times['play_start']
+                          if times.get('play_end') is not None and
+                          times.get('play_start') is not None else np.nan),
+        'ball_end_y': ball[-1, 3] if len(ball) else np.nan,
+        'bar_end_y': bar[-1, 3] if len(bar) else np.nan,
+        'ball_joy_active': np.mean(ball_joy[:, 3] != 0) if len(ball_joy) else np.nan,
+        'bar_joy_active': np.mean(bar_joy[:, 3] != 0) if len(bar_joy) else np.nan,
+        'bar_accel_max': accel.max() if len(accel) else np.nan,
+        'bar_accel_mean': accel.mean() if len(accel) else np.nan,
+        'break_requested': index in trial.get('breakTrials', []),
+        'latency_mean': network.get('latency_mean', np.nan),
+        'corrections': network.get('corrections', np.nan),
+    })
+    row.update(zip(PROFILE_COLUMNS, _profile(accel)))
+    return row
+
+def read_session(path, offset=0, info=None, name=None):
+    # Read the trials of a session file starting at byte offset. Returns
+    # the session info, the trials read, and the offset to pick up from
+    # next time. Lines that are not yet complete are left for later.
+    # info must be given when starting partway into the file; name labels
+    # the session's rows and defaults to the file name.
+    rows = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    pos = 0
+    while pos < len(data):
+        end = data.find(b'\n', pos)
+        complete = end >= 0
+        line = data[pos:end if complete else len(data)]
+        try:
+            block = json.loads(line.decode('utf-8')) if line.strip() else None
+        except ValueError:
+            # a trial still being written
+            break
+        if block is None:
+            pass
+        elif 'experiment' in block:
+            # header (or the trailer, which repeats it)
+            if info is None:
+                info = session_info(block, name or os.path.basename(path))
+        elif info is None:
+            raise ValueError('{} does not start with session metadata'.format(path))
+        elif not complete:
+            # a trial is only done once its newline is written; only the
+            # trailer is written without one
+            break
+        elif 'ball_history' in block:
+            rows.append(block)
+        if not complete:
+            break
+        pos = end + 1
+    return info, rows, offset + pos
+
+class Study(object):
+    # Per-trial summary table over all sessions in a data directory.
+    #
+    # The table and a manifest of the files it was built from (size,
+    # modification time, and how far each file has been read) are cached
+    # in datadir/study_summary.pkl. update() reads only what has changed
+    # since: new files in full, and the new trials of files that have
+    # grown. Files that changed in any other way are read again from the
+    # start, and rows for files that are gone are dropped.
+
+    def __init__(self, datadir, cache=None):
+        self.datadir = datadir
+        self.cache = cache or os.path.join(datadir, CACHE_NAME)
+        self.manifest = {}
+        self.table = pd.DataFrame()
+        if os.path.exists(self.cache):
+            saved = pd.read_pickle(self.cache)
+            if saved.get('version') == CACHE_VERSION:
+                self.manifest = saved['manifest']
+                self.table = saved['table']
+
+    def save(self):
+        pd.to_pickle({'version': CACHE_VERSION, 'manifest': self.manifest,
+                      'table': self.table}, self.cache)
+
+    def session_files(self):
+        # all json files under datadir
+        files = []
+        for root, dirs, names in os.walk(self.datadir):
+            for name in sorted(names):
+                if name.endswith('.json'):
+                    files.append(os.path.relpath(os.path.join(root, name), self.datadir))
+        return files
+
+    def update(self, save=True):
+        # Bring the table up to date with the files on disk. Returns the
+        # number of trials added.
+        files = self.session_files()
+        stale = set(self.manifest) - set(files)
+        new_rows = []
+        # copies of removed sessions get counted in their place
+        for name, entry in list(self.manifest.items()):
+            if entry.get('duplicate_of') in stale:
+                del self.manifest[name]
+        claimed = dict((entry['info']['session'], name)
+                       for name, entry in self.manifest.items()
+                       if entry.get('info') and name not in stale)
+
+        for name in files:
+            path = os.path.join(self.datadir, name)
+            st = os.stat(path)
+            entry = self.manifest.get(name)
+            if entry is not None:
+                if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                    continue
+                if st.st_size < entry['size'] or entry.get('duplicate_of'):
+                    # rewritten: start over
+                    stale.add(name)
+                    entry = None
+            if entry is None:
+                offset, info, ntrials = 0, None, 0
+            else:
+                offset, info, ntrials = entry['offset'], entry['info'], entry['trials']
+
+            try:
+                info, trials, offset = read_session(path, offset, info, name)
+            except ValueError:
+                # not a session file
+                self.manifest[name] = {'size': st.st_size, 'mtime': st.st_mtime,
+                                       'offset': 0, 'info': None, 'trials': 0}
+                continue
+
+            entry = {'size': st.st_size, 'mtime': st.st_mtime,
+                     'offset': offset, 'info': info, 'trials': ntrials}
+            if info is not None:
+                owner = claimed.setdefault(info['session'], name)
+                if owner != name:
+                    # e.g. a converted copy of a session already counted
+                    entry['duplicate_of'] = owner
+                    self.manifest[name] = entry
+                    continue
+            for trial in trials:
+                entry['trials'] += 1
+                new_rows.append(summarize_trial(trial, info, entry['trials']))
+            self.manifest[name] = entry
+
+        # drop rows for files that were removed or are being reread
+        if stale and len(self.table):
+            self.table = self.table[~self.table['file'].isin(stale)]
+        for name in stale:
+            if name in self.manifest and not os.path.exists(os.path.join(self.datadir, name)):
+                del self.manifest[name]
+
+        if new_rows and len(self.table):
+            self.table = pd.concat([self.table, pd.DataFrame(new_rows)],
+                                   ignore_index=True)
+        elif new_rows:
+            self.table = pd.DataFrame(new_rows)
+        if save and (new_rows or stale):
+            self.save()
+        return len(new_rows)
+
+    def query(self, by, value='win', agg='mean'):
+        # group the table by the column(s) in by and aggregate value
+        return self.table.groupby(by)[value].agg(agg)
+
+    def win_rate(self, by=('day', 'subject')):
+        # fraction of trials won, and number of finished trials, per group
+        return self.table.groupby(list(by))['win'].agg(['mean', 'count']).rename(
+            columns={'mean': 'win_rate', 'count': 'trials'})
+
+    def accel_profiles(self, by='winner'):
+        # mean bar acceleration over normalized play time, per group
+        return self.table.groupby(by)[PROFILE_COLUMNS].mean()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize all penaltyshot sessions in a data directory")
+    parser.add_argument(dest='datadir',
+                        help="Directory containing session .json files")
+    parser.add_argument('--by', nargs='+', default=['day', 'subject'],
+                        help="Columns to group win rates by")
+    parser.add_argument('--csv', default=None,
+                        help="Also write the per-trial table to this file")
+
+    args = parser.parse_args()
+
+    study = Study(args.datadir)
+    added = study.update()
+    print('{} trials added, {} trials total'.format(added, len(study.table)))
+    if len(study.table):
+        print(study.win_rate(args.by))
+    if args.csv:
+        study.table.to_csv(args.csv)
@@ -0,0 +1,274 @@
+# Compact encoding of the per-frame streams saved with each trial.
+#
+# Most of what gets written per frame is redundant: joystick axes sit at
+# exactly 0 inside the dead zone, the ball's x advances by a constant
+# BallSpeed every frame, the bar only moves while its joystick is pushed,
+# and every history carries the same two time columns. Each column of a
+# stream is stored as a sequence of segments, either
+#
+#   - a run of length L > 0: a start value and a step, reconstructed by
+#     adding the step L-1 times (a step of 0 is a run of a constant), or
+#   - a literal stretch of length L, stored as lengths entry -L and
+#     followed by the L values themselves.
+#
+# Columns that are exact multiples of 1/scale for a known joystick scale
+# are stored as integers with that scale, and a column that is identical
+# to one already stored in the same trial is stored as a reference to it.
+# Every column is checked on encoding to decode back bit-for-bit, and is
+# stored as a single literal stretch if it does not.
+
+from __future__ import division, print_function
+import numpy as np
+import argparse
+import json
+import os
+
+ENCODING = 'rle1'
+
+# streams in a trial dict that are encoded
+STREAMS = ['ball_history', 'ball_joystick_history', 'bar_history',
+           'bar_joystick_history', 'bar_acceleration', 'bar_max_move']
+
+# scales that joystick axis values are quantized to by the hardware
+# backends (pygame reports int16 axes divided by one of these)
+QUANT_SCALES = [32768, 32767]
+
+def _same(a, b):
+    # bit-for-bit equality of two float64 arrays (tells 0.0 from -0.0)
+    return a.shape == b.shape and np.array_equal(a.view(np.int64), b.view(np.int64))
+
+def _quantize(v):
+    # Return (q, scale) if v is exactly q/scale for integer q, else None.
+    if not np.all(np.isfinite(v)):
+        return None
+    for scale in [1] + QUANT_SCALES:
+        q = np.round(v * scale)
+        if np.all(np.abs(q) < 2**52) and _same(q / scale, v):
+            return q.astype(np.int64), scale
+    return None
+
+def _segments(v):
+    # Split the list v into (start, step, length) runs that are reproduced
+    # exactly by repeated addition of step. Runs of 1 or 2 elements are
+    # merged into literal stretches (start, None, length).
+    segs = []
+    n = len(v)
+    i = 0
+    while i < n:
+        j = i + 1
+        if j < n:
+            step = v[j] - v[i]
+            while j < n and v[j - 1] + step == v[j]:
+                j += 1
+        length = j - i
+        if length > 2:
+            segs.append((i, step, length))
+        elif segs and segs[-1][1] is None:
+            segs[-1] = (segs[-1][0], None, segs[-1][2] + length)
+        else:
+            segs.append((i, None, length))
+        i = j
+    return segs
+
+def _pack(v, scale=None):
+    # build the column dict for the array v (ints if scale is given)
+    v = v.tolist()
+    lengths, values, steps = [], [], []
+    for start, step, length in _segments(v):
+        if step is None:
+            lengths.append(-length)
+            values.extend(v[start:start + length])
+        else:
+            lengths.append(length)
+            values.append(v[start])
+            steps.append(step)
+    col = {'n': len(v), 'lengths': lengths, 'values': values, 'steps': steps}
+    if scale is not None:
+        col['scale'] = scale
+    return col
+
+def encode_column(v):
+    # Encode a 1-d array of floats as a json-ready dict.
+    v = np.asarray(v, dtype=float)
+    quantized = _quantize(v)
+    if quantized is not None:
+        col = _pack(*quantized)
+    else:
+        col = _pack(v)
+    if not _same(decode_column(col), v):
+        col = {'n': len(v), 'lengths': [-len(v)] if len(v) else [],
+               'values': v.tolist(), 'steps': []}
+    return col
+
+def decode_column(col):
+    # Decode a column dict back into a 1-d float array.
+    n = col['n']
+    lengths = np.asarray(col['lengths'], dtype=np.int64)
+    scale = col.get('scale')
+    dtype = np.int64 if scale is not None else float
+    values = np.asarray(col['values'], dtype=dtype)
+    steps = np.asarray(col['steps'], dtype=dtype)
+    if n == 0:
+        return np.zeros(0)
+    if len(lengths) == 1:
+        # whole column is one segment
+        if lengths[0] < 0:
+            out = values
+        elif steps[0] == 0:
+            out = np.repeat(values, n)
+        else:
+            out = np.cumsum(np.r_[values, np.repeat(steps, n - 1)])
+        return out / scale if scale is not None else out.astype(float)
+
+    is_run = lengths > 0
+    seg_len = np.abs(lengths)
+    seg_start = np.cumsum(seg_len) - seg_len
+    # each run uses one entry of values, each literal stretch uses seg_len
+    used = np.where(is_run, 1, seg_len)
+    val_start = np.cumsum(used) - used
+
+    # position of each frame within its segment
+    seg_id = np.repeat(np.arange(len(lengths)), seg_len)
+    within = np.arange(n) - seg_start[seg_id]
+
+    # literal frames index straight into values; run frames start from
+    # the run's start value
+    idx = val_start[seg_id] + np.where(is_run[seg_id], 0, within)
+    out = values[idx]
+
+    # runs with a nonzero step are rebuilt by repeated addition, which is
+    # how the values were computed in the first place: each run becomes a
+    # row [start, step, step, ...] that is summed along the row. Runs are
+    # grouped by length (within a factor of 2) to limit padding.
+    stepping = steps != 0
+    if stepping.any():
+        run_idx = np.flatnonzero(is_run)[stepping]
+        starts = seg_start[run_idx]
+        lens = seg_len[run_idx]
+        run_steps = steps[stepping]
+        group = np.ceil(np.log2(lens)).astype(int)
+        for g in np.unique(group):
+            sel = group == g
+            width = lens[sel].max()
+            rows = np.empty((sel.sum(), width), dtype=dtype)
+            rows[:] = run_steps[sel][:, None]
+            rows[:, 0] = out[starts[sel]]
+            rows = np.cumsum(rows, axis=1)
+            inside = np.arange(width) < lens[sel][:, None]
+            pos = starts[sel][:, None] + np.arange(width)
+            out[pos[inside]] = rows[inside]
+
+    if scale is not None:
+        out = out / scale
+    return out.astype(float)
+
+def encode_stream(history, seen=None, name=None):
+    # Encode a stream (a list of per-frame tuples, or a list of numbers).
+    # seen maps the bytes of already encoded columns to where they are
+    # stored, so repeated columns are stored as references.
+    arr = np.asarray(history, dtype=float)
+    shape = list(arr.shape)
+    if arr.ndim == 1:
+        arr = arr[:, None]
+    elif arr.size == 0:
+        arr = arr.reshape(0, 0)
+    columns = []
+    for c in range(arr.shape[1]):
+        v = np.ascontiguousarray(arr[:, c])
+        key = v.tobytes()
+        if seen is not None and key in seen:
+            columns.append({'ref': seen[key]})
+            continue
+        columns.append(encode_column(v))
+        if seen is not None and name is not None and len(v) > 2:
+            seen[key] = [name, c]
+    return {'encoding': ENCODING, 'shape': shape, 'columns': columns}
+
+def decode_stream(stream, trial=None, cache=None, name=None):
+    # Decode a stream into an array. Streams that were never encoded
+    # (i.e., plain lists) are converted as they are. trial is needed to
+    # resolve references to columns of other streams; cache, if given,
+    # keeps decoded columns so that each is only decoded once.
+    if not isinstance(stream, dict):
+        return np.asarray(stream, dtype=float)
+    if cache is None:
+        cache = {}
+    columns = []
+    for c, col in enumerate(stream['columns']):
+        key = tuple(col['ref']) if 'ref' in col else (name, c)
+        if key not in cache:
+            if 'ref' in col:
+                col = trial[key[0]]['columns'][key[1]]
+            cache[key] = decode_column(col)
+        columns.append(cache[key])
+    shape = tuple(stream['shape'])
+    if len(shape) == 1:
+        # copy, since the column may be shared with other streams
+        return columns[0].copy() if columns else np.zeros(0)
+    if not columns:
+        return np.zeros(shape)
+    return np.column_stack(columns)
+
+def encode_trial(trial):
+    # Return a copy of a trial dict with its streams encoded.
+    out = dict(trial)
+    seen = {}
+    for name in STREAMS:
+        if name in trial:
+            out[name] = encode_stream(trial[name], seen, name)
+    return out
+
+def decode_trial(trial):
+    # Return a copy of a trial dict with its streams decoded into arrays.
+    out = dict(trial)
+    cache = {}
+    for name in STREAMS:
+        if name in trial:
+            out[name] = decode_stream(trial[name], trial, cache, name)
+    return out
+
+def expand_trial(trial):
+    # Return a copy of a trial dict with its streams decoded back into
+    # plain lists, as they are written when CompactStreams is off.
+    out = decode_trial(trial)
+    for name in STREAMS:
+        if name in out:
+            out[name] = out[name].tolist()
+    return out
+
+def is_encoded(trial):
+    return any(isinstance(trial.get(name), dict) for name in STREAMS)
+
+def convert_file(infile, outfile, compact=True):
+    # Rewrite a session file with its trials encoded (or decoded back to
+    # plain lists if compact is False).
+    with open(infile, 'r') as f, open(outfile, 'w') as out:
+        for line in f:
+            if not line.strip():
+                continue
+            block = json.loads(line)
+            if 'experiment' in block:
+                block['settings']['CompactStreams'] = compact
+            elif compact:
+                block = encode_trial(block)
+            else:
+                block = expand_trial(block)
+            json.dump(block, out)
+            out.write('\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert session files to or from compact stream encoding")
+    parser.add_argument(nargs='+', dest='files',
+                        help="Session .json files")
+    parser.add_argument('--expand', action='store_true',
+                        help="Decode to plain lists instead of encoding")
+
+    args = parser.parse_args()
+
+    suffix = '_expanded' if args.expand else '_compact'
+    for file in args.files:
+        stem, ext = os.path.splitext(file)
+        outfile = stem + suffix + ext
+        convert_file(file, outfile, compact=not args.expand)
+        print('{}: {:.1f} kB -> {:.1f} kB'.format(outfile,
+              os.path.getsize(file) / 1e3, os.path.getsize(outfile) / 1e3))
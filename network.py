@@ -0,0 +1,651 @@
+# Networked versus play. Each machine runs the task with its own joystick
+# and streams that joystick's per-frame samples to its peer over UDP.
+# Both machines run the full physics: the opponent's input for frames
+# that have not arrived yet is predicted, and when the real samples come
+# in and disagree with the prediction, play is rolled back to the first
+# wrong frame and re-simulated. Physics only depends on the per-frame
+# inputs, so both machines end up with identical trials.
+#
+# The machine playing the ball leads: it schedules the start of each
+# trial, and decides the outcome of each trial and sends it to the other
+# machine, so that both always save the same winner.
+#
+# For testing on one machine, run a stand-in peer with simulated latency:
+#
+#     python network.py --port 5006 --peer 127.0.0.1:5005 --latency 0.05
+#
+# and start the task with peer 127.0.0.1:5006 and local port 5005.
+
+from __future__ import division, print_function
+import numpy as np
+import argparse
+import heapq
+import json
+import random
+import select
+import socket
+import struct
+import time
+from timeit import default_timer as clock
+import physics
+
+# kind, trial, first frame, send time, echoed peer send time, echo hold time
+HEADER = struct.Struct('!BIiddd')
+SAMPLE = struct.Struct('!dd')
+ELAPSED = struct.Struct('!d')  # START payload
+COUNT = struct.Struct('!i')  # NACK payload
+HELLO, READY, INPUT, BYE, START, ACK, NACK, RESULT = range(8)
+
+# most samples sent in one packet when resending
+MAX_RESEND = 64
+
+# settings that must agree on both machines for physics and trial timing
+# to match
+SHARED_SETTINGS = ['ScreenRect', 'frameDur', 'BallSpeed', 'BallRadius',
+                   'BallPauseStart', 'BarLength', 'BarWidth', 'FinalLine',
+                   'BallStartingPosX', 'BallStartingPosY',
+                   'BarStartingPosX', 'BarStartingPosY',
+                   'BarJoystickBaseSpeed', 'BarJoystickAccelIncr',
+                   'FixCrossJitterMean', 'TimeToWaitAfterOutcome']
+
+def parse_address(address):
+    # turn 'host:port' into a (host, port) tuple
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def fingerprint(settings, role):
+    # what gets exchanged with the peer at connection time
+    shared = dict((key, settings[key]) for key in SHARED_SETTINGS)
+    return {'role': role, 'settings': json.loads(json.dumps(shared))}
+
+class NetLink(object):
+    # Small wrapper around a nonblocking UDP socket talking to one peer.
+    #
+    # Every packet carries its send time and an echo of the last send time
+    # received from the peer (along with how long it was held before being
+    # echoed). From these, the round trip time can be measured without
+    # synchronized clocks; half of it is taken as the one-way latency.
+
+    def __init__(self, port, peer):
+        self.peer = peer if isinstance(peer, tuple) else parse_address(peer)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', int(port)))
+        self.sock.setblocking(False)
+        self._echo_t = 0.
+        self._echo_recv = None
+        self.latencies = []
+        self.closed = False
+        self.info = None
+        self.result = None  # (trial, winner) of the last trial we decided
+        self.pending_start = None  # (trial, time) of the leader's first START
+
+    def _transmit(self, data):
+        self.sock.sendto(data, self.peer)
+
+    def _receive(self, timeout):
+        # return the raw datagrams waiting on the socket
+        datagrams = []
+        while select.select([self.sock], [], [], timeout)[0]:
+            timeout = 0.
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except socket.error:
+                # e.g., ICMP port unreachable before the peer is up
+                continue
+            datagrams.append(data)
+        return datagrams
+
+    def send(self, kind, trial=0, frame=0, payload=b''):
+        now = clock()
+        hold = now - self._echo_recv if self._echo_recv is not None else 0.
+        self._transmit(HEADER.pack(kind, trial, frame, now, self._echo_t, hold) + payload)
+
+    def send_samples(self, trial, first, samples):
+        payload = b''.join(SAMPLE.pack(jx, jy) for jx, jy in samples)
+        self.send(INPUT, trial, first, payload)
+
+    def send_result(self, trial, winner, frames):
+        self.result = (trial, winner, frames)
+        self.send(RESULT, trial, frames, json.dumps(winner).encode('utf-8'))
+
+    def poll(self, timeout=0.):
+        # Return all packets waiting on the socket as a list of
+        # (kind, trial, frame, payload) tuples.
+        packets = []
+        for data in self._receive(timeout):
+            if len(data) < HEADER.size:
+                continue
+            now = clock()
+            kind, trial, frame, t_sent, echo_t, hold = HEADER.unpack_from(data)
+            if t_sent > self._echo_t:
+                self._echo_t = t_sent
+                self._echo_recv = now
+            if echo_t > 0:
+                self.latencies.append((now - echo_t - hold) / 2.)
+            if kind == BYE:
+                self.closed = True
+            packets.append((kind, trial, frame, data[HEADER.size:]))
+        return packets
+
+    def latency(self):
+        # current estimate of the one-way latency
+        if not self.latencies:
+            return 0.
+        return float(np.median(self.latencies[-20:]))
+
+    def handshake(self, info, timeout):
+        # Exchange info dicts with the peer. Returns the peer's info, or
+        # None if the peer could not be reached within timeout seconds.
+        self.info = info
+        peer_info = None
+        peer_has_ours = False
+        end = clock() + timeout
+        while clock() < end and not (peer_info and peer_has_ours):
+            self._send_hello(peer_info is not None)
+            for kind, trial, frame, data in self.poll(0.1):
+                if kind == HELLO:
+                    msg = json.loads(data.decode('utf-8'))
+                    peer_info = msg['info']
+                    peer_has_ours = peer_has_ours or msg['seen']
+                elif kind in (READY, INPUT):
+                    # peer has moved on, so it must have seen us
+                    peer_has_ours = True
+        if peer_info is not None:
+            # make sure the peer hears that we've seen it
+            self._send_hello(True)
+        return peer_info if peer_has_ours else None
+
+    def _send_hello(self, seen):
+        msg = {'info': self.info, 'seen': seen}
+        self.send(HELLO, payload=json.dumps(msg).encode('utf-8'))
+
+    def _send_ready(self, trial):
+        # READY carries the outcome of the last trial we decided, in case
+        # the peer missed it
+        msg = {'result': self.result}
+        self.send(READY, trial, payload=json.dumps(msg).encode('utf-8'))
+
+    def wait_ready(self, trial, timeout, leader):
+        # Agree with the peer on when this trial starts. Both sides send
+        # READY until the leader has heard from the follower. The leader
+        # then sends START, with the time since its first START, until the
+        # follower acknowledges it. The trial starts one (estimated)
+        # one-way latency after the leader's first START on the leader,
+        # and when that START arrives on the follower.
+        #
+        # Returns how long ago the trial started (negative if it is still
+        # to come), or None if the peer has quit or did not show up in time.
+        # In the latter case it can be called again to keep waiting, and
+        # picks up where it left off. The follower answers STARTs that
+        # arrive after this returns through Rollback.poll.
+        end = clock() + timeout
+        t_first = None
+        if self.pending_start is not None and self.pending_start[0] == trial:
+            t_first = self.pending_start[1]
+        while clock() < end and not self.closed:
+            if t_first is not None:
+                self.send(START, trial, payload=ELAPSED.pack(clock() - t_first))
+            else:
+                self._send_ready(trial)
+            for kind, ptrial, frame, data in self.poll(0.05):
+                if kind == HELLO:
+                    # peer missed the end of the handshake
+                    self._send_hello(True)
+                elif ptrial < trial:
+                    continue
+                elif leader and kind == READY and t_first is None:
+                    t_first = clock()
+                    self.pending_start = (trial, t_first)
+                    self.send(START, trial, payload=ELAPSED.pack(0.))
+                elif leader and kind in (ACK, INPUT) and t_first is not None:
+                    return clock() - (t_first + self.latency())
+                elif not leader and kind == START:
+                    elapsed, = ELAPSED.unpack_from(data)
+                    self.send(ACK, trial)
+                    return elapsed
+        return None
+
+    def close(self):
+        self.send(BYE)
+        self.sock.close()
+
+class SimulatedLatencyLink(NetLink):
+    # NetLink that holds packets back for a random delay, in both
+    # directions, and drops some of them, to stand in for a slow network
+    # on loopback. The latency the peer measures is therefore about the
+    # given latency.
+
+    def __init__(self, port, peer, latency=0.05, jitter=0.01, loss=0.):
+        super(SimulatedLatencyLink, self).__init__(port, peer)
+        self.latency_mean = latency
+        self.jitter = jitter
+        self.loss = loss
+        self._outgoing = []
+        self._incoming = []
+        self._count = 0
+
+    def _hold(self, queue, data):
+        if random.random() < self.loss:
+            return
+        due = clock() + max(random.gauss(self.latency_mean, self.jitter), 0.)
+        self._count += 1
+        heapq.heappush(queue, (due, self._count, data))
+
+    def _transmit(self, data):
+        self._hold(self._outgoing, data)
+        self.flush()
+
+    def flush(self):
+        # send everything that is due
+        now = clock()
+        while self._outgoing and self._outgoing[0][0] <= now:
+            NetLink._transmit(self, heapq.heappop(self._outgoing)[2])
+
+    def _receive(self, timeout):
+        # wake up in time to send and deliver held packets while waiting
+        end = clock() + timeout
+        while True:
+            self.flush()
+            for data in super(SimulatedLatencyLink, self)._receive(0.):
+                self._hold(self._incoming, data)
+            now = clock()
+            due = []
+            while self._incoming and self._incoming[0][0] <= now:
+                due.append(heapq.heappop(self._incoming)[2])
+            if due or now >= end:
+                return due
+            wait = end - now
+            for queue in [self._outgoing, self._incoming]:
+                if queue:
+                    wait = min(wait, queue[0][0] - now)
+            select.select([self.sock], [], [], max(wait, 0.))
+
+class LocalJoystick(object):
+    # Wraps a JoystickServer so that each frame is sampled exactly once
+    # and can be replayed when the trial is re-simulated.
+
+    def __init__(self, server):
+        self.server = server
+        self.samples = []
+        self.frame = 0
+
+    def reset(self):
+        self.samples = []
+        self.frame = 0
+
+    def sample(self):
+        jx, jy = self.server.CalibratedJoystickAxes()
+        self.samples.append((float(jx), float(jy)))
+
+    def CalibratedJoystickAxes(self):
+        return self.samples[self.frame]
+
+    def JoystickEscape(self):
+        return self.server.JoystickEscape()
+
+class RemoteJoystick(object):
+    # Stands in for the peer's JoystickServer. Returns the peer's sample
+    # for the current frame if it has arrived, and otherwise predicts it
+    # by holding the most recent sample that has.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.samples = {}
+        self.predicted = {}
+        self.latest = -1  # latest frame received
+        self.complete = 0  # number of leading frames all received
+        self.frame = 0
+
+    def CalibratedJoystickAxes(self):
+        frame = self.frame
+        if frame in self.samples:
+            return self.samples[frame]
+        prediction = (0., 0.)
+        for f in range(min(frame, self.latest), -1, -1):
+            if f in self.samples:
+                prediction = self.samples[f]
+                break
+        self.predicted[frame] = prediction
+        return prediction
+
+    def JoystickEscape(self):
+        return False
+
+    def confirmed(self, nframes):
+        # whether samples for all of the first nframes frames have arrived
+        return self.complete >= nframes
+
+    def receive(self, first, samples):
+        # Store samples starting at frame first. Returns the earliest
+        # frame that was predicted wrongly, or None.
+        wrong = None
+        for frame, sample in enumerate(samples, first):
+            if frame in self.samples:
+                continue
+            self.samples[frame] = sample
+            self.latest = max(self.latest, frame)
+            if frame in self.predicted:
+                if self.predicted.pop(frame) != sample and wrong is None:
+                    wrong = frame
+        while self.complete in self.samples:
+            self.complete += 1
+        return wrong
+
+class Rollback(object):
+    # Runs play for one trial at a time with a local and a remote joystick.
+    # Call poll() once per frame of the trial to answer the peer and take
+    # in its samples, and step() once per frame from the start of play.
+    # winner holds the outcome of the trial so far, and settled() says
+    # when it is final.
+    #
+    # The machine playing the ball is the leader. Its outcome is final
+    # once the peer's samples for every frame played have arrived (or
+    # after NetSettleTimeout), and it then sends it to the follower. The
+    # follower always takes the leader's outcome, and only falls back on
+    # its own if the leader goes silent for NetReadyTimeout.
+
+    def __init__(self, link, ball, bar, local, remote, settings):
+        self.link = link
+        self.ball = ball
+        self.bar = bar
+        self.local = local
+        self.remote = remote
+        self.settings = settings
+        self.redundancy = settings['NetInputRedundancy']
+        self.leader = ball.joystick is local
+        self.trial = 0
+
+    def start_trial(self, trial):
+        self.trial = trial
+        self.local.reset()
+        self.remote.reset()
+        self.gts = []  # global time of each frame
+        self.winner = None
+        self.t_winner = None
+        self.final = False
+        self.source = None  # which machine decided the outcome
+        self.agreed = None  # whether our own simulation agreed with it
+        self.result = None  # (winner, frames) sent by the leader
+        self.t_result = None
+        self.t_nack = -np.inf
+        self.corrections = 0
+        self.resimulated = 0
+        self.nacks = 0
+        self.resent = 0
+        self.link.latencies = []
+
+    @property
+    def simulated(self):
+        return len(self.ball.history)
+
+    def _simulate(self, frame):
+        # simulate one frame; physics time runs on frames so both
+        # machines agree on it
+        self.local.frame = self.remote.frame = frame
+        t = frame * self.settings['frameDur']
+        physics.update_bar(self.gts[frame], t, self.bar, self.settings)
+        physics.update_ball(self.gts[frame], t, self.ball, self.settings)
+        self.winner = physics.check_outcome(self.ball, self.bar, self.settings)
+        if self.winner and self.t_winner is None:
+            self.t_winner = clock()
+
+    def _catch_up(self):
+        while not self.winner and self.simulated < len(self.gts):
+            self._simulate(self.simulated)
+
+    def _rewind(self, frame):
+        # restore the state at the start of frame
+        for stim in [self.ball, self.bar]:
+            x, y = stim.history[frame][2:]
+            stim.setPos((x, y), log=False)
+            del stim.history[frame:]
+            del stim.jhistory[frame:]
+        del self.bar.accel[frame:]
+        del self.bar.maxmove[frame:]
+        self.winner = None
+        self.t_winner = None
+
+    def step(self, gt):
+        # sample and send the local joystick for the next frame, then
+        # play forward as far as possible
+        frame = len(self.gts)
+        self.local.sample()
+        self.gts.append(gt)
+        first = max(frame + 1 - self.redundancy, 0)
+        self.link.send_samples(self.trial, first, self.local.samples[first:])
+        if self.final:
+            if self.leader:
+                # keep telling the follower until the trial is over
+                self.link.send_result(self.trial, self.winner, self.simulated)
+        else:
+            self._catch_up()
+
+    def _resend(self, first, count):
+        # send our samples for frames first to first + count again
+        samples = self.local.samples[first:first + count]
+        for i in range(0, len(samples), MAX_RESEND):
+            self.link.send_samples(self.trial, first + i, samples[i:i + MAX_RESEND])
+        self.resent += len(samples)
+
+    def poll(self):
+        wrong = None
+        for kind, trial, frame, data in self.link.poll():
+            if kind == START and trial == self.trial:
+                # our ACK was lost
+                self.link.send(ACK, trial)
+            elif kind == READY and trial > self.trial and data:
+                # the leader has moved on; its READY repeats the outcome
+                result = json.loads(data.decode('utf-8'))['result']
+                if result and result[0] == self.trial and self.result is None:
+                    self.result = (result[1], result[2])
+                    self.t_result = clock()
+            elif trial != self.trial:
+                continue
+            elif kind == RESULT and self.result is None:
+                self.result = (json.loads(data.decode('utf-8')), frame)
+                self.t_result = clock()
+            elif kind == NACK:
+                count, = COUNT.unpack_from(data)
+                self._resend(frame, count)
+            elif kind == INPUT:
+                samples = [SAMPLE.unpack_from(data, i * SAMPLE.size)
+                           for i in range(len(data) // SAMPLE.size)]
+                frame = self.remote.receive(frame, samples)
+                if frame is not None and (wrong is None or frame < wrong):
+                    wrong = frame
+
+        if self.final:
+            return
+        if wrong is not None and wrong < self.simulated:
+            self.corrections += 1
+            self.resimulated += self.simulated - wrong
+            self._rewind(wrong)
+            self._catch_up()
+
+        # ask for frames that are missing behind ones that have arrived,
+        # or that are needed to settle the outcome
+        needed = max(self.remote.latest + 1, self.simulated if self.winner else 0)
+        missing = needed - self.remote.complete
+        wait = max(2 * self.link.latency(), self.settings['frameDur'])
+        if missing > 0 and clock() - self.t_nack > wait:
+            self.link.send(NACK, self.trial, self.remote.complete, COUNT.pack(missing))
+            self.nacks += 1
+            self.t_nack = clock()
+
+    def _finalize(self, winner, source):
+        self.agreed = winner == self.winner
+        if self.result is not None:
+            self.agreed = self.agreed and self.result[1] == self.simulated
+        self.winner = winner
+        self.source = source
+        self.final = True
+        if self.leader:
+            self.link.send_result(self.trial, winner, self.simulated)
+
+    def settled(self):
+        # Whether the outcome of the trial is final (see above).
+        if self.final:
+            return True
+        now = clock()
+        if self.leader:
+            if self.winner and (self.remote.confirmed(self.simulated) or
+                                now - self.t_winner > self.settings['NetSettleTimeout']):
+                self._finalize(self.winner, 'local')
+        elif self.result is not None:
+            # wait for our own simulation to catch up with the leader's,
+            # so that the saved histories match too
+            caught_up = self.winner and self.remote.confirmed(self.simulated)
+            if caught_up or now - self.t_result > self.settings['NetSettleTimeout']:
+                self._finalize(self.result[0], 'peer')
+        elif self.winner and (self.link.closed or
+                              now - self.t_winner > self.settings['NetReadyTimeout']):
+            # leader is gone
+            self._finalize(self.winner, 'local')
+        return self.final
+
+    def stats(self):
+        lat = np.array(self.link.latencies)
+        return {'frames': self.simulated,
+                'corrections': self.corrections,
+                'resimulated_frames': self.resimulated,
+                'confirmed': self.remote.confirmed(self.simulated),
+                'outcome_from': self.source,
+                'outcome_agreed': self.agreed,
+                'nacks_sent': self.nacks,
+                'frames_resent': self.resent,
+                'latency_mean': float(lat.mean()) if lat.size else None,
+                'latency_max': float(lat.max()) if lat.size else None,
+                'latency_samples': int(lat.size)}
+
+class HeadlessStim(object):
+    # just enough of a PsychoPy stim for the physics to move it around
+
+    def __init__(self, pos):
+        self.pos = pos
+
+    def setPos(self, pos, log=True):
+        self.pos = tuple(pos)
+
+class ScriptedJoystick(object):
+    # Smoothly wandering joystick input with a dead zone, sampled once per
+    # frame. A new wave is started with start().
+
+    def __init__(self, frameDur, deadzone=0.1, seed=None):
+        self.frameDur = frameDur
+        self.deadzone = deadzone
+        self.rng = np.random.RandomState(seed)
+        self.start()
+
+    def start(self):
+        self.phase = self.rng.uniform(0, 2 * np.pi)
+        self.freq = self.rng.uniform(0.3, 1.5)
+        self.frame = 0
+
+    def CalibratedJoystickAxes(self):
+        jy = float(np.sin(2 * np.pi * self.freq * self.frame * self.frameDur + self.phase))
+        self.frame += 1
+        return 0., jy if abs(jy) >= self.deadzone else 0.
+
+    def JoystickEscape(self):
+        return False
+
+def play_headless(link, settings, role, seed=None, trials=None, verbose=True):
+    # Play the role side of a networked session without a joystick or
+    # display, on the same schedule as penaltyshot.py. Returns a list of
+    # per-trial records.
+    frameDur = settings['frameDur']
+    ball = HeadlessStim(None)
+    bar = HeadlessStim(None)
+    joystick = ScriptedJoystick(frameDur, settings['Joystick0_DeadZone'], seed)
+    local = LocalJoystick(joystick)
+    remote = RemoteJoystick()
+    if role == 'ball':
+        ball.joystick, bar.joystick = local, remote
+    else:
+        ball.joystick, bar.joystick = remote, local
+    rollback = Rollback(link, ball, bar, local, remote, settings)
+
+    records = []
+    trial = 1
+    while not link.closed and (trials is None or trial <= trials):
+        lag = link.wait_ready(trial, settings['NetReadyTimeout'], rollback.leader)
+        if lag is None:
+            # peer gone, or still on a break
+            if verbose and not link.closed:
+                print('trial {}: still waiting for peer'.format(trial))
+            continue
+        start = clock() - lag
+        play_start = start + settings['FixCrossJitterMean']
+
+        ball.setPos((settings['BallStartingPosX'], settings['BallStartingPosY']))
+        bar.setPos((settings['BarStartingPosX'], settings['BarStartingPosY']))
+        for stim in [ball, bar]:
+            stim.history = []
+            stim.jhistory = []
+        bar.accel = []
+        bar.maxmove = []
+        joystick.start()
+        rollback.start_trial(trial)
+
+        end = np.inf
+        while not link.closed and clock() < end:
+            rollback.poll()
+            now = clock()
+            # step every frame that is due since the start of play
+            while now >= play_start + len(rollback.gts) * frameDur:
+                rollback.step(now)
+            if end == np.inf and rollback.settled():
+                end = now + settings['TimeToWaitAfterOutcome']
+            time.sleep(0.001)
+
+        record = {'winner': rollback.winner,
+                  'ball_history': ball.history, 'bar_history': bar.history,
+                  'network': rollback.stats()}
+        records.append(record)
+        if verbose:
+            print('Trial {}: {}, {}'.format(trial, rollback.winner, record['network']))
+        trial += 1
+    return records
+
+def run_standin(link, seed=None):
+    # Wait for the task to connect, take the other role, and play with
+    # the task's settings.
+    from settings import settings as defaults
+
+    peer = None
+    while peer is None:
+        for kind, trial, frame, data in link.poll(0.5):
+            if kind == HELLO:
+                peer = json.loads(data.decode('utf-8'))['info']
+    role = 'bar' if peer['role'] == 'ball' else 'ball'
+    link.handshake({'role': role, 'settings': peer['settings']}, 10.)
+    print('Connected to {} playing {}'.format(link.peer, peer['role']))
+
+    settings = dict(defaults)
+    settings.update(peer['settings'])
+    play_headless(link, settings, role, seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in peer for networked versus play")
+    parser.add_argument('--port', type=int, default=5006,
+                        help="Local UDP port")
+    parser.add_argument('--peer', default='127.0.0.1:5005',
+                        help="Address of the task as host:port")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Simulated one-way latency (s), applied in each direction")
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help="Standard deviation of latency (s)")
+    parser.add_argument('--loss', type=float, default=0.,
+                        help="Fraction of packets dropped in each direction")
+    parser.add_argument('--seed', type=int, default=None)
+
+    args = parser.parse_args()
+
+    link = SimulatedLatencyLink(args.port, args.peer, args.latency,
+                                args.jitter, args.loss)
+    try:
+        run_standin(link, seed=args.seed)
+    finally:
+        link.close()
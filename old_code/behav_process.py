@@ -6,13 +6,20 @@ import json
 import argparse
 import sys
 
+# session streams may be saved compactly encoded (see encoding.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from encoding import expand_trial, is_encoded
+
 def open_to_blocks(filename):
     with open(filename, 'r') as f:
         blocks = []
         while True:
             this_block = f.readline()
             if len(this_block) > 0:
-                blocks.append(json.loads(this_block))
+                block = json.loads(this_block)
+                if is_encoded(block):
+                    block = expand_trial(block)
+                blocks.append(block)
             else:
                 break
     return blocks
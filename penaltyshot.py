@@ -9,6 +9,8 @@ from psychopy.constants import *  # things like STARTED, FINISHED
 from psychopy.hardware import joystick
 from input_handler import JoystickServer
 import physics
+import network
+import encoding
 from datetime import datetime
 import sys
 import os
@@ -74,17 +76,40 @@ joystick.backend = 'pygame'
 nJoysticks = joystick.getNumJoysticks()
 logging.log(level=logging.EXP, msg='{} joysticks detected'.format(nJoysticks))
 
+# with a network peer, the opponent plays on their own machine
+networked = bool(config['Peer'])
+
 if nJoysticks == 0:
     print('There is no joystick connected!')
     core.quit()
 else:
     J0 = JoystickServer(0, settings['Joystick0_DeadZone'])
-    if nJoysticks > 1:
+    if networked:
+        pass
+    elif nJoysticks > 1:
         J1 = JoystickServer(1, settings['Joystick1_DeadZone'])
     else:
         print('You need two joysticks to play!')
         core.quit()
 breakTrials = []
+breakRequested = False
+
+# connect to peer and make sure both machines will play the same game
+if networked:
+    link = network.NetLink(config['Port'], config['Peer'])
+    info = network.fingerprint(settings, config['Role'])
+    print('Waiting for peer at {}...'.format(config['Peer']))
+    peer = link.handshake(info, settings['NetConnectTimeout'])
+    if peer is None:
+        print('Could not connect to peer at {}!'.format(config['Peer']))
+        core.quit()
+    elif peer['role'] == config['Role']:
+        print('Both players chose to play as {}!'.format(config['Role']))
+        core.quit()
+    elif peer['settings'] != info['settings']:
+        print('Peer settings do not match! Check screen size and frame rate.')
+        core.quit()
+    logging.log(level=logging.EXP, msg='Connected to peer at {}'.format(config['Peer']))
 
 ########## Set up stims #####################
 fixation = visual.TextStim(win, text='+',
@@ -135,13 +160,25 @@ endExpNow = False  # flag for 'escape' or other condition => quit the exp
 thisTrial = 0
 logging.log(level=logging.EXP, msg='Starting task')
 metadata['task_start_time'] = globalClock.getTime()
-#new block logic--subject will always be the shooter
-ball.joystick = J0
-bar.joystick = J1
-#if ball.joystick is J0:
-jmsg = 'Joysticks: Ball = 0, Bar = 1'
-#else:
-#    jmsg = 'Joysticks: Ball = 1, Bar = 0'
+if networked:
+    # local player uses joystick 0, the opponent's input comes from the peer
+    local = network.LocalJoystick(J0)
+    remote = network.RemoteJoystick()
+    if config['Role'] == 'ball':
+        ball.joystick, bar.joystick = local, remote
+        jmsg = 'Joysticks: Ball = 0, Bar = peer'
+    else:
+        ball.joystick, bar.joystick = remote, local
+        jmsg = 'Joysticks: Ball = peer, Bar = 0'
+    rollback = network.Rollback(link, ball, bar, local, remote, settings)
+else:
+    #new block logic--subject will always be the shooter
+    ball.joystick = J0
+    bar.joystick = J1
+    #if ball.joystick is J0:
+    jmsg = 'Joysticks: Ball = 0, Bar = 1'
+    #else:
+    #    jmsg = 'Joysticks: Ball = 1, Bar = 0'
 logging.log(level=logging.EXP, msg=jmsg)
 
 while not endExpNow:  # main experiment loop
@@ -213,6 +250,32 @@ while not endExpNow:  # main experiment loop
     bar.accel = []
     bar.maxmove = []
 
+    # agree with peer on when the trial starts
+    if networked:
+        trialLag = link.wait_ready(thisTrial, settings['NetReadyTimeout'], rollback.leader)
+        if trialLag is None and not link.closed:
+            # peer may be on a break: keep waiting until it comes back or
+            # the experimenter quits
+            logging.log(level=logging.EXP, msg='Still waiting for peer before trial {}'.format(thisTrial))
+            message_text.setText('Waiting for the other player...\n(escape to quit)', log=False)
+        while trialLag is None and not link.closed:
+            message_text.draw()
+            win.flip()
+            if event.getKeys(keyList=['escape']):
+                break
+            trialLag = link.wait_ready(thisTrial, 1., rollback.leader)
+        if trialLag is None:
+            msg = 'Lost connection to peer!' if link.closed else 'Quit while waiting for peer'
+            print(msg)
+            logging.log(level=logging.EXP, msg='{} (before trial {})'.format(msg, thisTrial))
+            break
+        logging.log(level=logging.EXP, msg='Trial start offset from peer schedule: {}'.format(trialLag))
+        # shift the trial schedule so that play starts at the same time
+        # (and so on the same frame) on both machines
+        fixStart -= trialLag
+        playStart -= trialLag
+        rollback.start_trial(thisTrial)
+
     # reset clocks
     t = 0  # time in trial
     frameN = -1  # frame within trial
@@ -238,7 +301,13 @@ while not endExpNow:  # main experiment loop
         event.clearEvents()
 
         # check for requested break:
-        if 'space' in theseKeys:
+        if 'space' in theseKeys and networked:
+        	# the peer can't wait on us mid-trial, so take the break
+        	# once this trial is over
+        	breakRequested = True
+        	logging.log(level=logging.EXP, msg='Sub needed break on trial {}'.format(thisTrial))
+        	breakTrials.append(thisTrial)
+        elif 'space' in theseKeys:
         	event.waitKeys()
         	logging.log(level=logging.EXP, msg='Sub needed break on trial {}'.format(thisTrial))
         	endExpNow = False
@@ -279,14 +348,34 @@ while not endExpNow:  # main experiment loop
             playOn = True
             playClock.reset()
 
+        # answer the peer and take in its input for the whole trial
+        if networked:
+            rollback.poll()
+            if link.closed:
+                print('Peer has quit!')
+                endTrialNow = True
+                endExpNow = True
+
         # handle actual game play
-        if playOn:
+        if playOn and networked:
+            # play forward with whatever input has arrived from the
+            # peer, predicting the rest
+            rollback.step(global_time)
+
+            # outcome only counts once both machines agree on it
+            if rollback.settled():
+                winner = rollback.winner
+        elif playOn:
             tt = playClock.getTime()
             physics.update_bar(global_time, tt, bar, settings)
             physics.update_ball(global_time, tt, ball, settings)
 
             # check outcome
             winner = physics.check_outcome(ball, bar, settings)
+        elif networked and tPlayStart is not None:
+            # keep streaming input (and the outcome, if we decided it) so
+            # the peer can settle the outcome
+            rollback.step(global_time)
 
         # conclusion of play
         if winner and playOn:
@@ -312,6 +401,9 @@ while not endExpNow:  # main experiment loop
     # clean up after trial
     tTrialEnd = global_time
     logging.log(level=logging.EXP, msg='End trial {}'.format(thisTrial))
+    if networked:
+        net_stats = rollback.stats()
+        logging.log(level=logging.EXP, msg='Network: {}'.format(net_stats))
     logging.flush()
 
     # save events to data object
@@ -333,12 +425,23 @@ while not endExpNow:  # main experiment loop
                             'trial_end': tTrialEnd
                             })
                 })
+    if networked:
+        this_dat['network'] = net_stats
+    if settings['CompactStreams']:
+        this_dat = encoding.encode_trial(this_dat)
     json.dump(this_dat, json_fp)  # dump to json
     json_fp.write('\n')  # write newline to flush buffer
     event.clearEvents()
 
+    # take a break requested during a networked trial
+    if breakRequested and not endExpNow:
+        event.waitKeys()
+        breakRequested = False
+
 # clean up after task
 logging.log(level=logging.EXP, msg='Ending task')
+if networked:
+    link.close()
 
 # log end time for the experiment
 t = datetime.now()
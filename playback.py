@@ -0,0 +1,410 @@
+# Playback of recorded penaltyshot sessions. Sessions are read through
+# a memory-mapped, line-indexed reader so that any trial can be reached
+# without parsing the ones before it. Trials can be watched at any speed
+# (or single-stepped) in a PsychoPy window, or batch-rendered offscreen
+# as trajectory plots.
+
+from __future__ import division, print_function
+import numpy as np
+import argparse
+import json
+import mmap
+import os
+from collections import OrderedDict
+from settings import compute_geometry
+from encoding import decode_trial
+
+# window size used by penaltyshot.py when not running fullscreen
+DEFAULT_SCREEN_RECT = (800, 600)
+
+# columns of the per-frame history tuples written by physics.py
+HISTORY_COLUMNS = ('global_time', 'time', 'x', 'y')
+
+class SessionReader(object):
+    # Random-access reader for a session json file. The file is
+    # memory-mapped and the byte offset of each line is indexed once on
+    # open; trials are only parsed when they are asked for, and the most
+    # recently used ones are kept in a small cache.
+    #
+    # The first line of a session file is the metadata, each following
+    # line is a trial, and a complete session ends with the metadata
+    # re-dumped with end times (and the screen geometry) filled in.
+
+    def __init__(self, filename, cache_size=32):
+        self.filename = filename
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._fp = open(filename, 'rb')
+        if os.fstat(self._fp.fileno()).st_size > 0:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = b''
+        spans = self._index_lines()
+
+        if not spans:
+            raise ValueError('{} is not a session file'.format(filename))
+        self.metadata = self._parse(spans[0])
+        self.trailer = None
+        if len(spans) > 1:
+            try:
+                last = self._parse(spans[-1])
+            except ValueError:
+                # a trial cut off partway through being written
+                spans = spans[:-1]
+            else:
+                if 'experiment' in last:
+                    self.trailer = last
+                    spans = spans[:-1]
+        self._spans = spans[1:]
+
+    def _index_lines(self):
+        # return (start, stop) byte offsets of every non-empty line
+        spans = []
+        start = 0
+        size = len(self._mm)
+        while start < size:
+            stop = self._mm.find(b'\n', start)
+            if stop < 0:
+                stop = size
+            if stop > start:
+                spans.append((start, stop))
+            start = stop + 1
+        return spans
+
+    def _parse(self, span):
+        start, stop = span
+        return json.loads(self._mm[start:stop].decode('utf-8'))
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, idx):
+        # return the raw trial dict for trial idx (0-indexed)
+        if idx < 0:
+            idx += len(self)
+        if idx in self._cache:
+            self._cache[idx] = self._cache.pop(idx)
+            return self._cache[idx]
+        trial = self._parse(self._spans[idx])
+        self._cache[idx] = trial
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return trial
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    @property
+    def complete(self):
+        # whether the session ran to completion (i.e., has a trailer)
+        return self.trailer is not None
+
+    def settings(self):
+        # Return the settings used for the session. Geometry is only
+        # written to file in the trailer, so for sessions that were cut
+        # short it is recomputed from the screen size given by
+        # screen_size().
+        if self.trailer is not None:
+            settings = dict(self.trailer['settings'])
+        else:
+            settings = dict(self.metadata['settings'])
+            settings.setdefault('frameDur', 1.0/60.0)
+            compute_geometry(settings, self.screen_size(),
+                             self.metadata['config']['BallSpeed'])
+        return settings
+
+    def screen_size(self):
+        # Screen size the session was recorded at. Sessions that were cut
+        # short don't have it saved, but the width follows from where the
+        # ball starts (BallStartingPosX = -3W/8). The height isn't
+        # recorded anywhere, so the default window's aspect ratio is
+        # assumed.
+        if self.trailer is not None:
+            return tuple(self.trailer['settings']['ScreenRect'])
+        W0, H0 = DEFAULT_SCREEN_RECT
+        for idx in range(len(self)):
+            ball = self.trial_arrays(idx)['ball_history']
+            if len(ball) and ball[0, 2] < 0:
+                W = int(round(-8. / 3. * ball[0, 2]))
+                return (W, int(round(W * H0 / W0)))
+        return DEFAULT_SCREEN_RECT
+
+    def trial_arrays(self, idx):
+        # Return the frame-by-frame histories of trial idx as arrays
+        # with one row per frame and columns given by HISTORY_COLUMNS.
+        # Compactly encoded streams are decoded here.
+        trial = decode_trial(self[idx])
+        out = {}
+        for key in ['ball_history', 'ball_joystick_history',
+                    'bar_history', 'bar_joystick_history']:
+            out[key] = _as_array(trial[key])
+        for key in ['bar_acceleration', 'bar_max_move']:
+            out[key] = np.asarray(trial[key], dtype=float)
+        out['winner'] = trial['winner']
+        return out
+
+def _as_array(history):
+    arr = np.asarray(history, dtype=float)
+    if arr.size == 0:
+        arr = arr.reshape(0, len(HISTORY_COLUMNS))
+    return arr
+
+def frame_at(times, t):
+    # index of the last frame shown at time t (in seconds since play start)
+    return max(np.searchsorted(times, t, side='right') - 1, 0)
+
+class Player(object):
+    # Interactive playback of a session in a PsychoPy window. Rebuilds
+    # the ball, bar and goal line from the session's geometry and moves
+    # them along the recorded histories.
+    #
+    # Keys:
+    #   space         pause/resume
+    #   left/right    step back/forward one frame (pauses)
+    #   up/down       double/halve playback speed
+    #   n/p           next/previous trial
+    #   g             go to trial (type number, then return)
+    #   f             go to frame of this trial (type number, then return)
+    #   escape        quit
+
+    def __init__(self, reader, speed=1.0):
+        from psychopy import visual
+
+        if len(reader) == 0:
+            raise ValueError('{} has no trials to play'.format(reader.filename))
+        self.reader = reader
+        self.speed = speed
+        self.settings = reader.settings()
+
+        self.win = visual.Window(size=self.settings['ScreenRect'],
+                                 units='pix', fullscr=False,
+                                 colorSpace='rgb255', color=(0, 0, 0))
+
+        s = self.settings
+        self.line = visual.Line(self.win,
+                                start=(s['FinalLine'], s['FinalLineHalfHeight']),
+                                end=(s['FinalLine'], -s['FinalLineHalfHeight']),
+                                name='goal_line')
+        self.ball = visual.Circle(self.win, radius=s['BallRadius'],
+                                  fillColor='gray', lineColor='gray',
+                                  name='ball')
+        barVertices = [ [-s['BarWidth']/2., s['BarLength']/2.],
+                        [s['BarWidth']/2., s['BarLength']/2.],
+                        [s['BarWidth']/2., -s['BarLength']/2.],
+                        [-s['BarWidth']/2., -s['BarLength']/2.] ]
+        self.bar = visual.ShapeStim(self.win, vertices=barVertices,
+                                    fillColor='gray', lineColor='gray',
+                                    name='bar')
+        self.info = visual.TextStim(self.win, text='', units='norm',
+                                    pos=(-0.98, 0.95), height=0.05,
+                                    alignHoriz='left', alignVert='top',
+                                    color=[255, 255, 255],
+                                    colorSpace='rgb255', name='info')
+
+        self.load(0)
+
+    def load(self, trial):
+        # seek to the start of a trial
+        self.trial = int(np.clip(trial, 0, len(self.reader) - 1))
+        arrs = self.reader.trial_arrays(self.trial)
+        self.ball_hist = arrs['ball_history']
+        self.bar_hist = arrs['bar_history']
+        self.winner = arrs['winner']
+        self.times = self.ball_hist[:, 1]
+        self.nframes = len(self.times)
+        self.frame = 0
+        self.t = self.times[0] if self.nframes else 0.
+
+    def seek(self, frame):
+        # jump to a frame within the current trial
+        self.frame = int(np.clip(frame, 0, max(self.nframes - 1, 0)))
+        if self.nframes:
+            self.t = self.times[self.frame]
+
+    def draw(self):
+        if self.nframes:
+            self.ball.setPos(self.ball_hist[self.frame, 2:], log=False)
+            self.bar.setPos(self.bar_hist[self.frame, 2:], log=False)
+        done = self.frame >= self.nframes - 1
+        self.info.setText('trial {}/{}  frame {}/{}  speed {:g}x{}'.format(
+            self.trial + 1, len(self.reader), self.frame + 1, self.nframes,
+            self.speed, '  ' + str(self.winner).upper() if done else ''),
+            log=False)
+        for stim in [self.line, self.ball, self.bar, self.info]:
+            stim.draw()
+        self.win.flip()
+
+    def run(self):
+        from psychopy import core, event
+
+        clock = core.Clock()
+        paused = False
+        typed = ''
+        target = None  # what typed digits go to: 'trial' or 'frame'
+        while True:
+            dt = clock.getTime()
+            clock.reset()
+
+            for key in event.getKeys():
+                if key == 'escape':
+                    self.win.close()
+                    return
+                elif key == 'space':
+                    paused = not paused
+                elif key == 'right':
+                    paused = True
+                    self.seek(self.frame + 1)
+                elif key == 'left':
+                    paused = True
+                    self.seek(self.frame - 1)
+                elif key == 'up':
+                    self.speed *= 2.
+                elif key == 'down':
+                    self.speed /= 2.
+                elif key == 'n':
+                    self.load(self.trial + 1)
+                elif key == 'p':
+                    self.load(self.trial - 1)
+                elif key == 'g':
+                    typed, target = '', 'trial'
+                elif key == 'f':
+                    typed, target = '', 'frame'
+                elif key.isdigit():
+                    typed += key
+                elif key == 'return' and typed:
+                    if target == 'frame':
+                        paused = True
+                        self.seek(int(typed) - 1)
+                    else:
+                        self.load(int(typed) - 1)
+                    typed = ''
+
+            if not paused and self.nframes:
+                self.t += dt * self.speed
+                if self.t > self.times[-1]:
+                    # hold on the final frame, then move on
+                    if self.t > self.times[-1] + self.settings['TimeToWaitAfterOutcome']:
+                        if self.trial < len(self.reader) - 1:
+                            self.load(self.trial + 1)
+                        else:
+                            paused = True
+                    self.frame = self.nframes - 1
+                else:
+                    self.frame = frame_at(self.times, self.t)
+
+            self.draw()
+
+def plot_trial(ax, arrs, settings):
+    # draw the ball and bar trajectories of one trial onto a matplotlib axis
+    W, H = settings['ScreenRect']
+    ball = arrs['ball_history']
+    bar = arrs['bar_history']
+    ax.axvline(settings['FinalLine'], color='k', lw=0.5)
+    if len(ball):
+        ax.plot(ball[:, 2], ball[:, 3], color='C0', lw=1)
+    if len(bar):
+        ax.plot(bar[:, 2], bar[:, 3], color='C3', lw=1)
+        ax.add_patch(_bar_patch(bar[-1, 2:], settings))
+    ax.set_xlim(-W/2., W/2.)
+    ax.set_ylim(-H/2., H/2.)
+    ax.set_aspect('equal')
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+def _bar_patch(pos, settings):
+    from matplotlib.patches import Rectangle
+    return Rectangle((pos[0] - settings['BarWidth']/2.,
+                      pos[1] - settings['BarLength']/2.),
+                     settings['BarWidth'], settings['BarLength'],
+                     color='C3', alpha=0.5)
+
+def render_session(reader, outfile=None, thumbdir=None, ncols=10):
+    # Offscreen rendering of a whole session in a single pass over the
+    # trials. Writes a grid of trajectory plots to outfile and/or one
+    # thumbnail per trial to thumbdir.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    settings = reader.settings()
+    ntrials = len(reader)
+    W, H = settings['ScreenRect']
+    aspect = H / W
+
+    if outfile is not None:
+        nrows = max(int(np.ceil(ntrials / ncols)), 1)
+        grid, axes = plt.subplots(nrows, ncols, squeeze=False,
+                                  figsize=(1.6 * ncols, 1.6 * aspect * nrows + 0.2))
+        for ax in axes.flat[ntrials:]:
+            ax.axis('off')
+    if thumbdir is not None and not os.path.exists(thumbdir):
+        os.makedirs(thumbdir)
+
+    for idx in range(ntrials):
+        arrs = reader.trial_arrays(idx)
+        title = '{} {}'.format(idx + 1, arrs['winner'])
+        if outfile is not None:
+            ax = axes.flat[idx]
+            plot_trial(ax, arrs, settings)
+            ax.set_title(title, fontsize=6)
+        if thumbdir is not None:
+            fig, ax = plt.subplots(figsize=(2., 2. * aspect))
+            plot_trial(ax, arrs, settings)
+            ax.set_title(title, fontsize=8)
+            fig.savefig(os.path.join(thumbdir, 'trial_{:04d}.png'.format(idx + 1)),
+                        dpi=100, bbox_inches='tight')
+            plt.close(fig)
+
+    if outfile is not None:
+        grid.tight_layout()
+        grid.savefig(outfile, dpi=150)
+        plt.close(grid)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play back or render recorded penaltyshot sessions",
+                                     epilog="Sessions that did not run to completion do not "
+                                            "have their screen size saved. Its width is "
+                                            "recovered from where the ball starts, and its "
+                                            "height is assumed to be in the proportions of "
+                                            "the default {}x{} window.".format(*DEFAULT_SCREEN_RECT))
+    parser.add_argument(nargs='+', dest='files',
+                        help="Session .json files")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Playback speed (multiple of real time)")
+    parser.add_argument('--trial', type=int, default=1,
+                        help="Trial to start playback at (1-indexed)")
+    parser.add_argument('--frame', type=int, default=1,
+                        help="Frame of that trial to start at (1-indexed)")
+    parser.add_argument('--offscreen', action='store_true',
+                        help="Render trajectory plots instead of playing back")
+    parser.add_argument('--thumbnails', action='store_true',
+                        help="With --offscreen, also write one image per trial")
+
+    args = parser.parse_args()
+
+    for file in args.files:
+        stem = os.path.splitext(file)[0]
+        with SessionReader(file) as reader:
+            if len(reader) == 0:
+                print('{}: no trials recorded, skipping'.format(file))
+            elif args.offscreen:
+                render_session(reader, outfile=stem + '_trials.png',
+                               thumbdir=stem + '_thumbs' if args.thumbnails else None)
+            else:
+                player = Player(reader, speed=args.speed)
+                player.load(args.trial - 1)
+                player.seek(args.frame - 1)
+                player.run()
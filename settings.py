@@ -1,4 +1,3 @@
-from psychopy import gui
 import sys
 
 def get_settings():
@@ -10,6 +9,9 @@ def get_settings():
     runType_options = ['experiment', 'train', 'Vs']
     goalieType_options = ['guess', 'react']
 
+    # imported here so that the geometry can be computed without psychopy
+    from psychopy import gui
+
     dlg = gui.Dlg(title='Choose Settings')
     dlg.addText('Penalty Shot Task', color="Blue")
     dlg.addText('Players', color="Blue")
@@ -19,6 +21,9 @@ def get_settings():
     dlg.addText('')
     dlg.addText('VS Variables', color="Blue")
     dlg.addField('Number of VS Trials', 20)
+    dlg.addField('Network peer (host:port, blank for one machine)', '')
+    dlg.addField('Local port', 5005)
+    dlg.addField('Play as (network only)', 'ball', choices=['ball', 'bar'])
     dlg.addText('')
     dlg.addText('Ball Parameters', color="Blue")
     dlg.addField('BallSpeed Factor', 1.0)
@@ -26,7 +31,8 @@ def get_settings():
     dlg.addField('FullScreen', True, choices=[False,True])
     dlg.addText('')
 
-    fieldnames = ['SubjName', 'P2', 'Day', 'trials_in_block', 'BallSpeed', 'full']
+    fieldnames = ['SubjName', 'P2', 'Day', 'trials_in_block', 'Peer',
+                  'Port', 'Role', 'BallSpeed', 'full']
 
     dlg.show()
     if dlg.OK:
@@ -46,7 +52,16 @@ def setup_geometry(settings, win, **kwargs):
         frameDur = 1.0/60.0 # couldn't get a reliable measure so guess
     settings['frameDur'] = frameDur
 
-    settings['ScreenRect'] = tuple(win.size)
+    compute_geometry(settings, win.size, kwargs['BallSpeed'])
+
+    return
+
+def compute_geometry(settings, size, BallSpeed):
+    # set up the geometry of the screen given a settings object, a screen
+    # size in pixels, and the ball speed factor. settings['frameDur'] must
+    # already be set. This is split out from setup_geometry so that
+    # recorded sessions can be rebuilt without an open window.
+    settings['ScreenRect'] = tuple(size)
     W = float(settings['ScreenRect'][0])
     H = float(settings['ScreenRect'][1])
     settings['BallRadius'] = W / 128.;
@@ -63,7 +78,7 @@ def setup_geometry(settings, win, **kwargs):
     #position of the joystick vertical axis (which lies between -1 and
     #1), we multiply that value by BallSpeed, ensuring that the
     #ball's max vertical speed is the same as its horizontal speed
-    ball_velocity = 1500. * kwargs['BallSpeed']  # in pix/s
+    ball_velocity = 1500. * BallSpeed  # in pix/s
     settings['BallSpeed'] = ball_velocity * settings['frameDur'] # in pix/frame
 
     # To allow for bar acceleration, we start them with a slower speed and
@@ -92,6 +107,13 @@ settings = {
     'Joystick0_DeadZone':0.1,
     'Joystick1_DeadZone': 0.1,
     'ActiveScreen': 0,
+    'CompactStreams': True, # save per-frame streams run-length encoded
+
+    # Networked versus play
+    'NetConnectTimeout': 60, # seconds to wait for the peer at startup
+    'NetReadyTimeout': 30, # seconds before saying we're waiting for the peer between trials
+    'NetSettleTimeout': 0.5, # seconds to wait for late samples at outcome
+    'NetInputRedundancy': 8, # frames of input repeated in each packet
 
     # Variables set before run
     'CurrentDate': 0,
@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aggregate import Study
+
+METADATA = {'experiment': 'penaltyshot', 'subject': 's1', 'day': 1,
+            'psychopy_start_time': 100.0, 'start_time': 'now',
+            'config': {'P2': 'p2', 'Role': 'ball'}, 'settings': {}}
+
+def make_trial(winner):
+    history = [[0., 0., 0., 0.], [0.1, 0.1, 1., 1.]]
+    return {'ball_history': history, 'bar_history': history,
+            'ball_joystick_history': history, 'bar_joystick_history': history,
+            'bar_acceleration': [0., 1.], 'bar_max_move': [1., 1.],
+            'winner': winner, 'times': {}}
+
+def test_trial_without_newline_is_read_once(tmp_path):
+    path = tmp_path / 'session.json'
+    with open(str(path), 'w') as f:
+        f.write(json.dumps(METADATA) + '\n')
+        f.write(json.dumps(make_trial('ball')) + '\n')
+        # still being written: all of the json, but not the newline
+        f.write(json.dumps(make_trial('bar')))
+    study = Study(str(tmp_path))
+    assert study.update(save=False) == 1
+
+    with open(str(path), 'a') as f:
+        f.write('\n')
+    assert study.update(save=False) == 1
+    assert list(study.table['trial']) == [1, 2]
+    assert list(study.table['winner']) == ['ball', 'bar']
+
+def test_trailer_without_newline(tmp_path):
+    path = tmp_path / 'session.json'
+    with open(str(path), 'w') as f:
+        f.write(json.dumps(METADATA) + '\n')
+        f.write(json.dumps(make_trial('ball')) + '\n')
+        f.write(json.dumps(METADATA))
+    study = Study(str(tmp_path))
+    assert study.update(save=False) == 1
+    assert study.update(save=False) == 0